@@ -8,16 +8,20 @@ Designed for Supabase integration with 24-hour timeout support.
 Deployment: modal deploy main.py
 """
 
+import asyncio
+import functools
+import hashlib
 import modal
-import json
 import os
+import re
+from collections import OrderedDict
 from typing import List, Dict, Any
 import time
 from fastapi import FastAPI, Request
 from tenacity import (
     retry,
     stop_after_attempt,
-    wait_exponential,
+    wait_exponential_jitter,
     retry_if_exception,
     before_sleep_log,
 )
@@ -34,14 +38,65 @@ app = modal.App("bulk-gpt-processor-mvp")
 image = modal.Image.debian_slim().pip_install(
     "google-generativeai>=0.8.5",
     "supabase>=2.0.0",
+    "asyncpg>=0.29.0",  # Direct Postgres writes, bypassing PostgREST
     "python-dotenv>=1.0.0",
     "fastapi[standard]>=0.115.0",
     "tenacity>=8.2.0",  # For retry logic with exponential backoff
+    "orjson>=3.9.0",  # Fast JSON serialization for the per-row hot path
+    "httpx[http2]>=0.27.0",  # HTTP/2 keep-alive client for hot-path PostgREST writes
 )
 
+# Import heavyweight clients once at container boot, not per invocation.
+# image.imports() suppresses ImportError locally where only `modal` exists.
+with image.imports():
+    import google.generativeai as genai
+    import httpx
+    import orjson
+    from realtime import AsyncRealtimeClient
+    from supabase import create_client
+
 # Create FastAPI app for HTTP endpoints
 web_app = FastAPI()
 
+# How many completed rows to buffer before flushing to Supabase in one
+# upsert; must stay below SUBBATCH_SIZE so a sub-batch flushes while its
+# remaining rows are still in flight
+RESULT_FLUSH_SIZE = 25
+
+# Flush a partial buffer after this many seconds without a new record
+RESULT_FLUSH_INTERVAL = 2
+
+# How many rows each Modal container processes (async-concurrently);
+# container startup cost is amortized over this many rows
+SUBBATCH_SIZE = 50
+
+# Cap on containers pre-warmed ahead of sub-batch dispatch
+MAX_WARM_CONTAINERS = 20
+
+# Gemini model used for all row processing
+GEMINI_MODEL_NAME = "gemini-2.0-flash-exp"
+
+# Gemini quota shared by all containers: 600 RPM = 10 rps sustained,
+# with a burst allowance of one bucket's worth of tokens
+GEMINI_RPS = 10
+GEMINI_TOKEN_CAPACITY = 60
+
+# Cross-container token bucket: each entry permits one Gemini call.
+# A scheduled refiller tops it up; workers take a token per request so
+# the whole fleet respects the quota, not just each container locally.
+gemini_token_queue = modal.Queue.from_name("gemini-tokens", create_if_missing=True)
+
+# Upsert statement for bulk result writes over asyncpg
+RESULT_UPSERT_SQL = """
+    INSERT INTO batch_results
+        (id, batch_id, row_index, input_data, output_data, status, error_message)
+    VALUES ($1, $2, $3, $4, $5, $6, $7)
+    ON CONFLICT (id) DO UPDATE SET
+        output_data = EXCLUDED.output_data,
+        status = EXCLUDED.status,
+        error_message = EXCLUDED.error_message
+"""
+
 # Gemini system prompt for consistent, high-quality output
 SYSTEM_PROMPT = """You are a specialized AI assistant for bulk data processing.
 
@@ -61,72 +116,355 @@ Remember: You're processing data in bulk, so consistency and accuracy are critic
 """
 
 
+@functools.lru_cache(maxsize=32)
+def compile_prompt_template(prompt: str) -> tuple:
+    """
+    Pre-parse a {{column}} template into alternating literal/key segments.
+
+    re.split with a capturing group yields [literal, key, literal, key,
+    ...], so per-row expansion is a single join instead of one full
+    string scan-and-reallocate per column. Keys match any CSV header the
+    frontend can insert (spaces, hyphens, etc.), mirroring
+    lib/gemini.ts's literal-placeholder replacement.
+    """
+    return tuple(re.split(r"\{\{([^{}]+)\}\}", prompt))
+
+
+def dumps_row(row: Dict[str, str]) -> str:
+    """Serialize a row for input_data storage (orjson: ~5x stdlib json)."""
+    return orjson.dumps(row).decode()
+
+
+@functools.lru_cache(maxsize=32)
+def build_generation_config(output_schema: tuple):
+    """
+    Build (once per batch) a JSON-mode generation config for a schema.
+
+    Passing response_schema makes Gemini emit the JSON object directly —
+    no prose wrapped around it, fewer output tokens, and no downstream
+    parse/repair stage — instead of steering it with a format hint
+    appended to the prompt.
+    """
+    if not output_schema:
+        return None
+
+    return genai.GenerationConfig(
+        response_mime_type="application/json",
+        response_schema={
+            "type": "object",
+            "properties": {column: {"type": "string"} for column in output_schema},
+            "required": list(output_schema),
+        },
+    )
+
+
+@functools.lru_cache(maxsize=32)
+def template_keys(prompt: str) -> frozenset:
+    """
+    Column names a template actually references.
+
+    Expansion only ever touches these keys (the odd segments of the
+    pre-parsed template), regardless of how many columns a row carries.
+    """
+    return frozenset(compile_prompt_template(prompt)[1::2])
+
+
+def render_prompt(segments: tuple, row: Dict[str, str]) -> str:
+    """Expand pre-parsed template segments with values from a row."""
+    return "".join(
+        str(row.get(seg) or "") if i % 2 else seg
+        for i, seg in enumerate(segments)
+    )
+
+
+@functools.lru_cache(maxsize=4)
+def get_model(gemini_api_key: str, model_name: str = GEMINI_MODEL_NAME):
+    """
+    Build (once per container) the Gemini model for a given API key.
+
+    Model construction re-parses the system instruction and tool config,
+    so it must not happen inside the per-row hot path.
+    """
+    genai.configure(api_key=gemini_api_key)
+    return genai.GenerativeModel(
+        model_name=model_name,
+        system_instruction=SYSTEM_PROMPT,
+    )
+
+
+@functools.lru_cache(maxsize=2)
+def get_supabase(supabase_url: str, supabase_key: str):
+    """Build (once per container) the Supabase client, reusing its HTTP session."""
+    return create_client(supabase_url, supabase_key)
+
+
+@functools.lru_cache(maxsize=2)
+def get_rest_client(supabase_url: str, supabase_key: str):
+    """
+    Build (once per container) an HTTP/2 client for PostgREST writes.
+
+    supabase-py's builder allocates wrapper objects per call and runs
+    HTTP/1.1; a bare httpx.AsyncClient with HTTP/2 keep-alive multiplexes
+    every result flush over one TLS connection. supabase-py remains in
+    use for the coarse batches status updates only.
+    """
+    return httpx.AsyncClient(
+        http2=True,
+        base_url=f"{supabase_url}/rest/v1",
+        headers={
+            "apikey": supabase_key,
+            "Authorization": f"Bearer {supabase_key}",
+            "Content-Type": "application/json",
+            "Prefer": "return=minimal,resolution=merge-duplicates",
+        },
+        limits=httpx.Limits(max_keepalive_connections=20),
+        timeout=30,
+    )
+
+
+# asyncpg pools cached per event loop: under @modal.concurrent all
+# inputs in a container share one loop, so this is one pool (and one
+# set of Postgres connections) per container for its whole lifetime
+_pg_pools: Dict[Any, Any] = {}
+_pg_pool_locks: Dict[Any, asyncio.Lock] = {}
+
+
+async def get_pg_pool():
+    """
+    Get the container's asyncpg pool for Supabase's session pooler.
+
+    Direct Postgres writes skip PostgREST's HTTP + JSON layer entirely
+    (sub-2ms per write vs hundreds of ms). Requires SUPABASE_DB_URL in
+    the Modal secret; returns None when unset so callers fall back to
+    the REST upsert path. statement_cache_size=0 is required by the
+    Supabase pooler.
+
+    The pool is created lazily on first use, cached per event loop, and
+    lives until the container stops — sub-batches reuse it instead of
+    paying connection handshakes per invocation. min_size=1 keeps idle
+    session-pooler slot usage low; the pool grows under load.
+    """
+    dsn = os.getenv("SUPABASE_DB_URL")
+    if not dsn:
+        return None
+
+    loop = asyncio.get_running_loop()
+    lock = _pg_pool_locks.setdefault(loop, asyncio.Lock())
+    async with lock:
+        if loop not in _pg_pools:
+            try:
+                import asyncpg
+
+                _pg_pools[loop] = await asyncpg.create_pool(
+                    dsn,
+                    min_size=1,
+                    max_size=20,
+                    max_inactive_connection_lifetime=300,
+                    statement_cache_size=0,
+                )
+            except Exception as e:
+                print(f"Warning: asyncpg pool unavailable, falling back to REST writes: {e}")
+                _pg_pools[loop] = None
+
+    return _pg_pools[loop]
+
+
+class PromptResponseCache:
+    """
+    Process-local LRU of Gemini outputs keyed by prompt hash.
+
+    Bulk workloads often repeat categorical inputs (same country, same
+    product category), which expand to identical prompts. A hit returns
+    the cached output in microseconds instead of re-spending a Gemini
+    call; with K distinct prompts across N rows, API traffic drops from
+    N to K calls per container.
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self._entries: OrderedDict = OrderedDict()
+
+    @staticmethod
+    def key_for(prompt: str) -> str:
+        return hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest()
+
+    def get(self, key: str):
+        output = self._entries.get(key)
+        if output is not None:
+            self._entries.move_to_end(key)
+        return output
+
+    def put(self, key: str, output: str) -> None:
+        self._entries[key] = output
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+# Shared by all rows processed in this container
+prompt_cache = PromptResponseCache()
+
+
+async def acquire_global_gemini_token(timeout: float = 60) -> None:
+    """
+    Take one token from the cross-container bucket before a Gemini call.
+
+    Degrades gracefully: if the queue is empty past the timeout or
+    unreachable, the caller proceeds under its local rate limiter only,
+    rather than failing the row.
+    """
+    try:
+        await asyncio.to_thread(gemini_token_queue.get, True, timeout)
+    except Exception:
+        pass
+
+
+class AsyncTokenBucket:
+    """
+    Token-bucket rate limiter for pacing Gemini API calls.
+
+    Tokens refill continuously at `refill_rate` per second up to
+    `capacity`, so short bursts are allowed while the sustained rate
+    stays within quota. Callers await acquire() before each API call;
+    when the bucket is empty the caller sleeps exactly as long as the
+    refill needs, instead of a fixed sleep between every call.
+
+    Defaults match Gemini's 600 RPM quota: 10 rps sustained with a
+    60-request burst.
+    """
+
+    def __init__(self, capacity: float = 60, refill_rate: float = 10):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: float = 1) -> None:
+        """Block until `tokens` tokens are available, then consume them."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.last_refill) * self.refill_rate,
+                )
+                self.last_refill = now
+
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+
+                await asyncio.sleep((tokens - self.tokens) / self.refill_rate)
+
+
 def is_retryable_error(exception: Exception) -> bool:
     """
     Determine if an exception is retryable (rate limits, timeouts, transient errors).
-    
+
+    Typed google.api_core exceptions are checked first: 429/5xx-class
+    errors retry, while InvalidArgument / PermissionDenied-class errors
+    fail immediately instead of burning retry attempts on a request that
+    can never succeed. String matching remains as a fallback for errors
+    raised outside the google.api_core hierarchy.
+
     Args:
         exception: The exception to check
-    
+
     Returns:
         True if the exception should trigger a retry, False otherwise
     """
+    try:
+        from google.api_core import exceptions as gapi_exceptions
+
+        # Permanent client-side errors: retrying cannot help
+        if isinstance(
+            exception,
+            (
+                gapi_exceptions.InvalidArgument,
+                gapi_exceptions.PermissionDenied,
+                gapi_exceptions.Unauthenticated,
+                gapi_exceptions.NotFound,
+                gapi_exceptions.FailedPrecondition,
+            ),
+        ):
+            return False
+
+        # Transient quota/server/network errors: retry with backoff
+        if isinstance(
+            exception,
+            (
+                gapi_exceptions.TooManyRequests,
+                gapi_exceptions.ResourceExhausted,
+                gapi_exceptions.ServiceUnavailable,
+                gapi_exceptions.InternalServerError,
+                gapi_exceptions.DeadlineExceeded,
+                gapi_exceptions.Aborted,
+            ),
+        ):
+            return True
+    except ImportError:
+        pass
+
     error_str = str(exception).lower()
-    
+
     # Retry on rate limit errors (429)
     if '429' in error_str or 'rate limit' in error_str or 'quota' in error_str:
         return True
-    
+
     # Retry on timeout errors
     if 'timeout' in error_str or 'timed out' in error_str:
         return True
-    
+
     # Retry on temporary network errors
     if 'connection' in error_str or 'network' in error_str:
         return True
-    
+
     # Retry on 500-level server errors
     if '500' in error_str or '502' in error_str or '503' in error_str or '504' in error_str:
         return True
-    
+
     return False
 
 
 @retry(
     retry=retry_if_exception(is_retryable_error),
-    stop=stop_after_attempt(3),  # Max 3 attempts
-    wait=wait_exponential(multiplier=2, min=4, max=60),  # 4s, 8s, 16s, ...
+    stop=stop_after_attempt(5),  # Max 5 attempts
+    wait=wait_exponential_jitter(initial=1, max=30),  # ~1s, 2s, 4s, ... + jitter
     before_sleep=before_sleep_log(logger, logging.INFO),
     reraise=True,
 )
-def call_gemini_with_retry(model, prompt: str) -> str:
+async def call_gemini_with_retry(model, prompt: str, generation_config=None) -> str:
     """
-    Call Gemini API with automatic retry on transient failures.
-    
-    Implements exponential backoff:
-    - Attempt 1: Immediate
-    - Attempt 2: Wait 4s
-    - Attempt 3: Wait 8s
-    
+    Call Gemini API with automatic retry on transient failures only.
+
+    Implements jittered exponential backoff (so concurrent rows hitting
+    the same 429 don't all retry in lock-step); permanent errors such as
+    InvalidArgument fail immediately.
+
+    The call is async so many requests can be in flight at once;
+    tenacity transparently awaits the coroutine between retries.
+
     Args:
         model: Gemini GenerativeModel instance
         prompt: The prompt to send to Gemini
-    
+        generation_config: Optional structured-output config
+
     Returns:
         The generated text response
-    
+
     Raises:
         Exception: If all retry attempts fail
     """
-    response = model.generate_content(prompt)
-    
+    response = await model.generate_content_async(prompt, generation_config=generation_config)
+
     if not response or not response.text:
         raise ValueError("No response generated from Gemini API")
-    
+
     return response.text
 
 
-def _process_single_row(
+async def _process_single_row(
     batch_id: str,
     row: Dict[str, str],
     row_index: int,
@@ -134,15 +472,16 @@ def _process_single_row(
     context: str,
     output_schema: List[str],
     gemini_api_key: str,
-    supabase_url: str,
-    supabase_key: str,
+    rate_limiter: AsyncTokenBucket = None,
 ) -> Dict[str, Any]:
     """
     Process a single CSV row through Gemini API.
-    
-    This is a pure function that processes one row independently.
-    It's designed to be called in parallel via Modal's .starmap().
-    
+
+    This is a pure coroutine that processes one row independently.
+    It's designed to be scheduled concurrently via asyncio.gather().
+    The caller is responsible for persisting the returned record;
+    results are buffered and written to Supabase in bulk.
+
     Args:
         batch_id: Unique identifier for the batch
         row: CSV row as dictionary
@@ -151,212 +490,515 @@ def _process_single_row(
         context: Additional context for the task
         output_schema: Expected output columns/format
         gemini_api_key: Gemini API key
-        supabase_url: Supabase project URL
-        supabase_key: Supabase service role key
-    
+        rate_limiter: Optional token bucket pacing Gemini calls
+
     Returns:
-        Dict with row_id, output, status, and optional error
+        Dict shaped like a batch_results record, ready to upsert
     """
-    import google.generativeai as genai
-    from supabase import create_client
-    
-    # Generate row ID
-    row_id = row.get("id", f"{batch_id}-row-{row_index}")
-    
-    # Initialize clients (Modal handles connection pooling)
-    genai.configure(api_key=gemini_api_key)
-    supabase = create_client(supabase_url, supabase_key)
-    
+    # Generate row ID (the fallback f-string is only built when needed)
+    row_id = row.get("id") or f"{batch_id}-row-{row_index}"
+
     try:
-        # Replace template variables in prompt
-        final_prompt = prompt
-        for key, value in row.items():
-            if key != "id" and value:
-                placeholder = f"{{{{{key}}}}}"
-                final_prompt = final_prompt.replace(placeholder, str(value))
-        
+        # Expand template variables (template parsed once per batch, cached)
+        final_prompt = render_prompt(compile_prompt_template(prompt), row)
+
         # Add context if provided
         if context:
             final_prompt = f"Context: {context}\n\n{final_prompt}"
         
-        # Add output schema hint if provided
-        if output_schema:
-            schema_hint = f"\n\nExpected output format: {', '.join(output_schema)}"
-            final_prompt = final_prompt + schema_hint
-        
-        # Call Gemini API with automatic retry
-        model = genai.GenerativeModel(
-            model_name="gemini-2.0-flash-exp",
-            system_instruction=SYSTEM_PROMPT,
+        # Request structured JSON output natively instead of appending a
+        # format hint to the prompt (config built once per schema, cached)
+        generation_config = build_generation_config(tuple(output_schema or ()))
+
+        # Identical prompts (repeated categorical inputs) skip the API call;
+        # the schema is part of the key since it shapes the response
+        cache_key = PromptResponseCache.key_for(
+            final_prompt + "\x00" + ",".join(output_schema or ())
         )
-        
-        # Use retry wrapper for resilient API calls
-        output = call_gemini_with_retry(model, final_prompt)
+        cached_output = prompt_cache.get(cache_key)
+
+        if cached_output is not None:
+            output = cached_output
+        else:
+            # Cached per container: no per-row model construction
+            model = get_model(gemini_api_key)
+
+            # Pace the call against Gemini quota (locally and fleet-wide),
+            # then call with automatic retry
+            if rate_limiter is not None:
+                await rate_limiter.acquire()
+            await acquire_global_gemini_token()
+            output = await call_gemini_with_retry(model, final_prompt, generation_config)
+            prompt_cache.put(cache_key, output)
+
         status = "success"
         error_msg = None
-        
+        error_type = None
+
     except Exception as api_error:
         output = ""
         status = "error"
         error_msg = str(api_error)
-        print(f"[{batch_id}] Error on row {row_index + 1}: {error_msg}")
-    
-    # Insert result into database
-    try:
-        supabase.table("batch_results").insert(
-            {
-                "id": row_id,
-                "batch_id": batch_id,
-                "row_index": row_index,
-                "input_data": json.dumps(row),
-                "output_data": output,
-                "status": status,
-                "error_message": error_msg,
-            }
-        ).execute()
-    except Exception as db_error:
-        print(f"[{batch_id}] Warning: Could not insert result {row_id}: {db_error}")
-    
+        # Transient errors exhausted their retries; permanent ones are
+        # real request failures — keep the distinction for batch stats
+        error_type = "transient" if is_retryable_error(api_error) else "permanent"
+        print(f"[{batch_id}] {error_type.capitalize()} error on row {row_index + 1}: {error_msg}")
+
     return {
         "id": row_id,
-        "output": output,
+        "batch_id": batch_id,
+        "row_index": row_index,
+        "input_data": dumps_row(row),
+        "output_data": output,
         "status": status,
-        "error": error_msg,
+        "error_message": error_msg,
+        "error_type": error_type,
     }
 
 
-@app.function(
-    image=image,
-    timeout=3600,  # 1 hour per row (generous for API calls)
-    memory=1024,  # 1GB per worker
-    secrets=[modal.Secret.from_name("bulk-gpt-env")],
-)
-def process_row(
+async def _process_rows_concurrently(
     batch_id: str,
-    row: Dict[str, str],
-    row_index: int,
+    rows: List[Dict[str, str]],
+    start_idx: int,
     prompt: str,
     context: str,
     output_schema: List[str],
-) -> Dict[str, Any]:
+    gemini_api_key: str,
+    supabase_url: str,
+    supabase_key: str,
+    concurrency: int = 32,
+) -> List[Dict[str, Any]]:
     """
-    Modal function to process a single row in parallel.
-    
-    This function is called via .starmap() to enable parallel processing.
-    Each invocation runs in its own container.
-    
+    Process a slice of rows concurrently inside one container.
+
+    Rows are dispatched as asyncio tasks and awaited together; a
+    semaphore bounds the number of in-flight Gemini requests and a token
+    bucket paces them against quota. Completed records are written to
+    Supabase in bulk by a background flusher.
+
     Args:
         batch_id: Unique identifier for the batch
-        row: CSV row as dictionary
-        row_index: Index of this row in the batch
+        rows: Slice of CSV rows as dictionaries
+        start_idx: Batch-wide index of the first row in the slice
         prompt: Template prompt with {{column}} placeholders
         context: Additional context for the task
         output_schema: Expected output columns/format
-    
+        gemini_api_key: Gemini API key
+        supabase_url: Supabase project URL
+        supabase_key: Supabase service role key
+        concurrency: Max number of rows processed simultaneously
+
     Returns:
-        Dict with row_id, output, status, and optional error
+        List of batch_results-shaped records, in row order
     """
-    # Get environment variables from Modal secret
-    gemini_api_key = os.getenv("GEMINI_API_KEY")
-    supabase_url = os.getenv("NEXT_PUBLIC_SUPABASE_URL") or os.getenv("SUPABASE_URL")
-    supabase_key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-    
-    if not all([gemini_api_key, supabase_url, supabase_key]):
-        return {
-            "id": f"{batch_id}-row-{row_index}",
-            "output": "",
-            "status": "error",
-            "error": "Missing required environment variables",
-        }
-    
-    # Call the pure processing function
-    return _process_single_row(
-        batch_id=batch_id,
-        row=row,
-        row_index=row_index,
-        prompt=prompt,
-        context=context,
-        output_schema=output_schema,
-        gemini_api_key=gemini_api_key,
-        supabase_url=supabase_url,
-        supabase_key=supabase_key,
-    )
+    # Guard against bad caller input: concurrency <= 0 would deadlock
+    # (Semaphore(0)) or raise, and this value arrives from the HTTP body
+    concurrency = max(1, concurrency)
+
+    # Flag template/CSV mismatches once per sub-batch instead of letting
+    # every row silently render empty values for the missing columns
+    if rows:
+        missing_columns = template_keys(prompt) - set(rows[0])
+        if missing_columns:
+            print(
+                f"[{batch_id}] Warning: prompt references columns not in the CSV: "
+                f"{', '.join(sorted(missing_columns))}"
+            )
+
+    semaphore = asyncio.Semaphore(concurrency)
+    rate_limiter = AsyncTokenBucket(capacity=60, refill_rate=10)
+
+    # Completed records flow through a queue to a background flusher that
+    # writes them in bulk, so DB writes overlap with in-flight Gemini calls.
+    # Writes go over asyncpg when SUPABASE_DB_URL is configured, else REST.
+    result_queue: asyncio.Queue = asyncio.Queue()
+    pg_pool = await get_pg_pool()
+
+    async def _flush(pending: List[Dict[str, Any]]) -> None:
+        if not pending:
+            return
+        try:
+            if pg_pool is not None:
+                await pg_pool.executemany(
+                    RESULT_UPSERT_SQL,
+                    [
+                        (
+                            r["id"],
+                            r["batch_id"],
+                            r["row_index"],
+                            r["input_data"],
+                            r["output_data"],
+                            r["status"],
+                            r["error_message"],
+                        )
+                        for r in pending
+                    ],
+                )
+            else:
+                # error_type is summary metadata, not a batch_results column
+                payload = [
+                    {k: v for k, v in r.items() if k != "error_type"}
+                    for r in pending
+                ]
+                response = await get_rest_client(supabase_url, supabase_key).post(
+                    "/batch_results",
+                    params={"on_conflict": "id"},
+                    content=orjson.dumps(payload),
+                )
+                response.raise_for_status()
+        except Exception as db_error:
+            print(f"[{batch_id}] Warning: Could not write {len(pending)} results: {db_error}")
+
+    async def _result_writer() -> None:
+        pending: List[Dict[str, Any]] = []
+        while True:
+            try:
+                record = await asyncio.wait_for(
+                    result_queue.get(), timeout=RESULT_FLUSH_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                # Quiet period: write out whatever has accumulated
+                await _flush(pending)
+                pending = []
+                continue
+            if record is None:
+                break
+            pending.append(record)
+            if len(pending) >= RESULT_FLUSH_SIZE:
+                await _flush(pending)
+                pending = []
+        await _flush(pending)
+
+    async def _one(row: Dict[str, str], idx: int) -> Dict[str, Any]:
+        async with semaphore:
+            record = await _process_single_row(
+                batch_id=batch_id,
+                row=row,
+                row_index=idx,
+                prompt=prompt,
+                context=context or "",
+                output_schema=output_schema or [],
+                gemini_api_key=gemini_api_key,
+                rate_limiter=rate_limiter,
+            )
+            await result_queue.put(record)
+            return record
+
+    writer_task = asyncio.create_task(_result_writer())
+    try:
+        tasks = [_one(row, start_idx + offset) for offset, row in enumerate(rows)]
+        results = list(await asyncio.gather(*tasks))
+    except Exception as parallel_error:
+        print(f"[{batch_id}] Error during concurrent processing: {parallel_error}")
+        results = []
+    finally:
+        await result_queue.put(None)
+        await writer_task
+
+    return results
 
 
-def _process_batch_internal(
+@app.cls(
+    image=image,
+    timeout=3600,  # 1 hour per sub-batch (generous for API calls)
+    memory=1024,  # 1GB per worker
+    secrets=[modal.Secret.from_name("bulk-gpt-env")],
+)
+@modal.concurrent(max_inputs=4)  # Up to 4 sub-batches share one container
+class BatchWorker:
+    """
+    Container-scoped worker for sub-batch processing.
+
+    The @modal.enter() hook runs once per container (not per input), so
+    credentials are read and the Gemini model / Supabase client caches
+    are warmed before the first row arrives. The work is pure I/O wait,
+    so @modal.concurrent lets one container interleave several sub-batch
+    inputs on its event loop instead of booting a container per input.
+    """
+
+    @modal.enter()
+    def setup(self):
+        """Read credentials and warm client caches once per container."""
+        self.gemini_api_key = os.getenv("GEMINI_API_KEY")
+        self.supabase_url = os.getenv("NEXT_PUBLIC_SUPABASE_URL") or os.getenv("SUPABASE_URL")
+        self.supabase_key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+
+        if self.gemini_api_key:
+            get_model(self.gemini_api_key)
+        if self.supabase_url and self.supabase_key:
+            get_rest_client(self.supabase_url, self.supabase_key)
+
+    @modal.method()
+    async def process_subbatch(
+        self,
+        batch_id: str,
+        start_idx: int,
+        prompt: str,
+        context: str,
+        output_schema: List[str],
+        concurrency: int = 32,
+    ) -> List[Dict[str, Any]]:
+        """
+        Process a sub-batch of rows in this container.
+
+        Called via .starmap() with SUBBATCH_SIZE-row slices: one container
+        boot and one set of client imports is amortized over the whole
+        slice, while rows inside the slice still run async-concurrently.
+
+        Row data is fetched from the batch's shared modal.Dict by
+        start_idx, so function arguments carry only indices instead of
+        duplicating every row through Modal's argument serialization.
+
+        Args:
+            batch_id: Unique identifier for the batch
+            start_idx: Batch-wide index of the first row in the slice
+                (negative means an empty warm-up input)
+            prompt: Template prompt with {{column}} placeholders
+            context: Additional context for the task
+            output_schema: Expected output columns/format
+            concurrency: Max in-flight Gemini calls within this container
+
+        Returns:
+            List of batch_results-shaped records, in row order
+        """
+        rows: List[Dict[str, str]] = []
+        if start_idx >= 0:
+            try:
+                rows = modal.Dict.from_name(f"rows-{batch_id}")[start_idx]
+            except Exception as e:
+                print(f"[{batch_id}] Error: could not fetch rows at {start_idx}: {e}")
+                return []
+
+        if not rows:
+            return []
+
+        if not all([self.gemini_api_key, self.supabase_url, self.supabase_key]):
+            return [
+                {
+                    "id": row.get("id") or f"{batch_id}-row-{start_idx + offset}",
+                    "batch_id": batch_id,
+                    "row_index": start_idx + offset,
+                    "input_data": dumps_row(row),
+                    "output_data": "",
+                    "status": "error",
+                    "error_message": "Missing required environment variables",
+                    "error_type": "permanent",
+                }
+                for offset, row in enumerate(rows)
+            ]
+
+        return await _process_rows_concurrently(
+            batch_id=batch_id,
+            rows=rows,
+            start_idx=start_idx,
+            prompt=prompt,
+            context=context,
+            output_schema=output_schema,
+            gemini_api_key=self.gemini_api_key,
+            supabase_url=self.supabase_url,
+            supabase_key=self.supabase_key,
+            concurrency=concurrency,
+        )
+
+
+async def _process_batch_internal(
     batch_id: str,
     rows: List[Dict[str, str]],
     prompt: str,
     context: str = "",
     output_schema: List[str] = None,
+    concurrency: int = 32,
 ) -> Dict[str, Any]:
     """
-    Internal function to orchestrate parallel batch processing.
-    
+    Internal coroutine to orchestrate batched fan-out processing.
+
+    Rows are split into SUBBATCH_SIZE slices and fanned out to Modal
+    containers via .starmap(); each container processes its slice
+    async-concurrently and writes its own results. Sub-batch outputs are
+    consumed as they finish (order_outputs=False) so progress reporting
+    is not blocked on the slowest slice.
+
     Args:
         batch_id: Unique identifier for this batch
         rows: List of CSV rows as dictionaries
         prompt: Template prompt with {{column}} placeholders
         context: Additional context for the task
         output_schema: Expected output columns/format
-    
+        concurrency: Max in-flight Gemini calls per container
+
     Returns:
         Dict with processing results and statistics
     """
-    from supabase import create_client
-    
-    # Get Supabase credentials for batch status updates
     supabase_url = os.getenv("NEXT_PUBLIC_SUPABASE_URL") or os.getenv("SUPABASE_URL")
     supabase_key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-    
+
     if not all([supabase_url, supabase_key]):
         raise ValueError("Missing required environment variables: SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY")
-    
-    # Create Supabase client for orchestrator
+
+    # Create Supabase client for orchestrator (cached per container)
     try:
-        supabase = create_client(supabase_url, supabase_key)
+        supabase = get_supabase(supabase_url, supabase_key)
     except Exception as e:
         raise RuntimeError(f"Failed to initialize Supabase client: {str(e)}")
-    
+
     # Initialize tracking
     start_time = time.time()
-    
-    print(f"[{batch_id}] Starting parallel batch processing with {len(rows)} rows")
-    
-    # Mark batch as processing (batch must be pre-created by Next.js API)
+
+    n_chunks = (len(rows) + SUBBATCH_SIZE - 1) // SUBBATCH_SIZE
+    print(
+        f"[{batch_id}] Starting batch processing: {len(rows)} rows in "
+        f"{n_chunks} sub-batches of up to {SUBBATCH_SIZE} (concurrency={concurrency})"
+    )
+
+    # Mark batch as processing (batch must be pre-created by Next.js API).
+    # Fired in the background so dispatch starts immediately instead of
+    # waiting a round-trip on a marker nobody reads synchronously.
+    async def _mark_processing() -> None:
+        try:
+            await asyncio.to_thread(
+                supabase.table("batches")
+                .update({"status": "processing", "updated_at": "now()"})
+                .eq("id", batch_id)
+                .execute
+            )
+        except Exception as e:
+            print(f"[{batch_id}] Warning: Could not update batch status: {e}")
+
+    mark_processing_task = asyncio.create_task(_mark_processing())
+
+    # Pre-warm one container per sub-batch slot (warm-up inputs return
+    # immediately after the @modal.enter() hook runs), so containers and
+    # their imports are already hot when the real slices arrive
+    worker = BatchWorker()
     try:
-        supabase.table("batches").update(
-            {"status": "processing", "updated_at": "now()"}
-        ).eq("id", batch_id).execute()
+        for _ in range(min(n_chunks, MAX_WARM_CONTAINERS)):
+            worker.process_subbatch.spawn(batch_id, -1, "", "", [], concurrency)
     except Exception as e:
-        print(f"[{batch_id}] Warning: Could not update batch status: {e}")
-    
-    # Process all rows in parallel using Modal's .starmap()
+        print(f"[{batch_id}] Warning: Container pre-warm failed: {e}")
+
+    # Stage row slices in a shared modal.Dict keyed by start index, so
+    # sub-batch dispatch sends indices instead of copying row payloads
+    rows_dict = None
+    try:
+        rows_dict = modal.Dict.from_name(f"rows-{batch_id}", create_if_missing=True)
+        for i in range(0, len(rows), SUBBATCH_SIZE):
+            rows_dict[i] = rows[i:i + SUBBATCH_SIZE]
+    except Exception as e:
+        raise RuntimeError(f"Failed to stage rows for batch {batch_id}: {e}")
+
+    # Broadcast progress deltas every 2s over a Realtime channel while
+    # sub-batches run; batches.processed_rows is only written once, at
+    # terminal completion. Clients subscribed to "batch:{id}" get smooth
+    # progress without polling (the status API remains as fallback).
+    results: List[Dict[str, Any]] = []
+    all_done = asyncio.Event()
+
+    # Realtime needs the async client: the sync supabase-py client has no
+    # realtime transport (its channel() raises NotImplementedError). If
+    # the socket can't be established, fall back to the periodic
+    # processed_rows DB updates so progress is never silently dropped.
+    realtime_client = None
+    progress_channel = None
+    try:
+        realtime_client = AsyncRealtimeClient(
+            f"{supabase_url}/realtime/v1".replace("http", "ws"), supabase_key
+        )
+        await realtime_client.connect()
+        progress_channel = realtime_client.channel(f"batch:{batch_id}")
+        await progress_channel.subscribe()
+    except Exception as e:
+        progress_channel = None
+        print(f"[{batch_id}] Warning: Realtime channel unavailable, reporting progress via DB: {e}")
+
+    async def _progress_reporter() -> None:
+        last_reported = -1
+        while not all_done.is_set():
+            try:
+                await asyncio.wait_for(all_done.wait(), timeout=2)
+            except asyncio.TimeoutError:
+                pass
+            done_count = sum(1 for r in results if r.get("status") == "success")
+            failed_count = sum(1 for r in results if r.get("status") == "error")
+            if done_count + failed_count == last_reported:
+                continue
+            last_reported = done_count + failed_count
+            if progress_channel is not None:
+                try:
+                    await progress_channel.send_broadcast(
+                        "progress",
+                        {"done": done_count, "failed": failed_count, "total": len(rows)},
+                    )
+                except Exception as e:
+                    print(f"[{batch_id}] Warning: Could not broadcast progress: {e}")
+            else:
+                try:
+                    await asyncio.to_thread(
+                        supabase.table("batches")
+                        .update({"processed_rows": done_count, "updated_at": "now()"})
+                        .eq("id", batch_id)
+                        .execute
+                    )
+                except Exception as e:
+                    print(f"[{batch_id}] Warning: Could not report progress: {e}")
+
+    reporter_task = asyncio.create_task(_progress_reporter())
+
+    # Fan out sub-batches and stream their outputs as they complete
     try:
-        results = list(process_row.starmap([
-            (batch_id, row, idx, prompt, context or "", output_schema or [])
-            for idx, row in enumerate(rows)
-        ]))
+        async for sub_results in worker.process_subbatch.starmap.aio(
+            [
+                (batch_id, i, prompt, context or "", output_schema or [], concurrency)
+                for i in range(0, len(rows), SUBBATCH_SIZE)
+            ],
+            order_outputs=False,
+        ):
+            results.extend(sub_results)
     except Exception as parallel_error:
         print(f"[{batch_id}] Error during parallel processing: {parallel_error}")
         results = []
-    
+    finally:
+        all_done.set()
+        await reporter_task
+        if rows_dict is not None:
+            try:
+                rows_dict.clear()
+            except Exception:
+                pass
+        if progress_channel is not None:
+            try:
+                await progress_channel.unsubscribe()
+            except Exception:
+                pass
+        if realtime_client is not None:
+            try:
+                await realtime_client.close()
+            except Exception:
+                pass
+
     # Calculate statistics
     successful_count = sum(1 for r in results if r.get("status") == "success")
     error_count = sum(1 for r in results if r.get("status") == "error")
+    transient_error_count = sum(1 for r in results if r.get("error_type") == "transient")
     total_time = time.time() - start_time
     avg_time_per_row = total_time / len(rows) if rows else 0
     
-    # Update batch as completed
+    # Single terminal write carrying both final status and processed_rows.
+    # Settle the start marker first so the two updates can't reorder.
+    await mark_processing_task
     completion_status = "completed" if error_count == 0 else "completed_with_errors"
     try:
-        supabase.table("batches").update(
-            {
-                "status": completion_status,
-                "processed_rows": successful_count,
-                "updated_at": "now()",
-            }
-        ).eq("id", batch_id).execute()
+        await asyncio.to_thread(
+            supabase.table("batches")
+            .update(
+                {
+                    "status": completion_status,
+                    "processed_rows": successful_count,
+                    "updated_at": "now()",
+                }
+            )
+            .eq("id", batch_id)
+            .execute
+        )
     except Exception as e:
         print(f"[{batch_id}] Warning: Could not finalize batch: {e}")
     
@@ -366,6 +1008,8 @@ def _process_batch_internal(
         "total_rows": len(rows),
         "successful": successful_count,
         "failed": error_count,
+        "failed_transient": transient_error_count,
+        "failed_permanent": error_count - transient_error_count,
         "processing_time_seconds": round(total_time, 2),
         "avg_time_per_row": round(avg_time_per_row, 3),
         "status": completion_status,
@@ -374,7 +1018,7 @@ def _process_batch_internal(
     
     print(
         f"[{batch_id}] Batch complete: {successful_count} success, "
-        f"{error_count} errors in {total_time:.1f}s (parallel processing)"
+        f"{error_count} errors in {total_time:.1f}s (concurrent processing)"
     )
     
     return summary
@@ -385,7 +1029,14 @@ def _process_batch_internal(
 async def process_batch_endpoint(request: Request):
     """HTTP endpoint for batch processing requests."""
     body = await request.json()
-    
+
+    # Clamp caller-supplied concurrency: non-numeric falls back to the
+    # default, zero/negative would deadlock the worker semaphore
+    try:
+        concurrency = max(1, int(body.get("concurrency", 32)))
+    except (TypeError, ValueError):
+        concurrency = 32
+
     # Spawn Modal function to process batch
     result = await process_batch_modal.remote.aio(
         batch_id=body.get("batch_id"),
@@ -393,6 +1044,7 @@ async def process_batch_endpoint(request: Request):
         prompt=body.get("prompt", ""),
         context=body.get("context", ""),
         output_schema=body.get("output_schema"),
+        concurrency=concurrency,
     )
     
     return result
@@ -411,9 +1063,12 @@ def process_batch_modal(
     prompt: str,
     context: str = "",
     output_schema: List[str] = None,
+    concurrency: int = 32,
 ) -> Dict[str, Any]:
     """Modal function that processes batches."""
-    return _process_batch_internal(batch_id, rows, prompt, context, output_schema)
+    return asyncio.run(
+        _process_batch_internal(batch_id, rows, prompt, context, output_schema, concurrency)
+    )
 
 
 # Expose FastAPI app as ASGI
@@ -424,6 +1079,22 @@ def fastapi_app():
     return web_app
 
 
+@app.function(image=image, schedule=modal.Period(seconds=1), timeout=30)
+def refill_gemini_tokens() -> None:
+    """
+    Top up the cross-container Gemini token bucket once per second.
+
+    Adds GEMINI_RPS tokens per tick, capped at GEMINI_TOKEN_CAPACITY so
+    idle periods accumulate at most one burst's worth of headroom.
+    """
+    try:
+        space = GEMINI_TOKEN_CAPACITY - gemini_token_queue.len()
+        for _ in range(min(GEMINI_RPS, max(space, 0))):
+            gemini_token_queue.put(1, block=False)
+    except Exception as e:
+        print(f"Warning: token refill failed: {e}")
+
+
 @app.function(image=image, timeout=60)
 def health_check() -> Dict[str, str]:
     """Health check endpoint for Modal."""